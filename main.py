@@ -1,9 +1,16 @@
 import asyncio
+import bisect
+import json
+import os
+import random
+import time
 from tapo import ApiClient, PlugEnergyMonitoringHandler
+from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Optional
 import logging
 from logging.handlers import RotatingFileHandler
+import numpy as np
 import env
 from price_info import fetch_electricity_prices, efficient_timeframes
 import web_app
@@ -11,79 +18,179 @@ import web_app
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Last fetched prices, used to start up without waiting for the price API
+PRICES_CACHE_FILE = "prices_cache.json"
+# Normalized (is_fixed, value) threshold for devices without their own configuration
+DEFAULT_THRESHOLD: Tuple[bool, float] = (False, web_app.DEFAULT_THRESHOLD_MULTIPLIER)
+
 class DeviceScheduler:
     def __init__(self) -> None:
         self.price_timeframes: Dict[str, List[Tuple[datetime, datetime, float, int]]] = {}  # Keyed by device name
+        self._timeframe_starts: Dict[str, List[datetime]] = {}  # Sorted timeframe starts per device, for bisect lookups
+        self._timeframe_ends: Dict[str, List[datetime]] = {}
+        self._norm_thresholds: Dict[str, Tuple[bool, float]] = {}  # Device name -> (is_fixed, value)
         self.credentials: Tuple[str, str] = env.CRED
+        self._api_client: ApiClient = ApiClient(*self.credentials)
         self.max_retries: int = 3
         self.retry_delay: float = 2.0
+        self.max_retry_delay: float = 30.0
+        self.jitter: float = 0.5  # Random +/- fraction applied to retry delays
+        self.max_idle: float = 15 * 60  # Longest the control loop sleeps without re-checking devices
+        self.failure_retry_interval: float = 60.0  # Longest the control loop sleeps after a device could not be read or set
+        self.state_ttl: float = 25.0  # Seconds a known device state is reused without querying the device
         self.loop = None
         self.last_prices = None
+        self.last_price_values: Optional[np.ndarray] = None  # Prices of last_prices as an array, aligned by index
+        self._prices_hash: Optional[int] = None  # Hash of the prices the current timeframes were built from
+        self._timeframes_version: Optional[int] = None  # web_app.config_version the current timeframes were built from
+        self._devices: Dict[str, PlugEnergyMonitoringHandler] = {}  # Cached connections keyed by IP
+        self._device_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)  # Serializes all traffic to one plug
+        self._state_cache: Dict[str, Tuple[float, bool]] = {}  # IP -> (monotonic time, is_on)
+        self._wake = asyncio.Event()  # Set when the control loop should re-check devices early
 
+    def _backoff(self, attempt: int) -> float:
+        """Capped exponential retry delay with jitter so devices don't retry in lockstep"""
+        delay = min(self.max_retry_delay, self.retry_delay * (2 ** attempt))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+    
     async def get_device(self, ip: str) -> PlugEnergyMonitoringHandler:
-        """Get device connection"""
-        client = ApiClient(*self.credentials)
-        return await client.p110(ip)
+        """Get device connection, reusing a cached handle when available (caller holds the device lock)"""
+        device = self._devices.get(ip)
+        if device is None:
+            device = await self._api_client.p110(ip)
+            self._devices[ip] = device
+        return device
+    
+    def normalize_thresholds(self, devices_snapshot: List[Tuple[str, web_app.DeviceRecord]]) -> None:
+        """Flatten each device's threshold config into an (is_fixed, value) tuple"""
+        self._norm_thresholds = {
+            device_name: (record.threshold_type == 'fixed', record.threshold_value)
+            for device_name, record in devices_snapshot
+        }
     
     def calculate_threshold_price(self, device_name: str, median_price: float) -> float:
         """Calculate the actual threshold price based on device configuration"""
-        if device_name not in web_app.device_thresholds:
-            logger.warning(f"Device {device_name} has no threshold configuration, using default (multiplier: {web_app.DEFAULT_THRESHOLD_MULTIPLIER})")
-            threshold_config = {'type': 'multiplier', 'value': web_app.DEFAULT_THRESHOLD_MULTIPLIER}
-        else:
-            threshold_config = web_app.device_thresholds[device_name]
+        is_fixed, value = self._norm_thresholds.get(device_name, DEFAULT_THRESHOLD)
+        return value if is_fixed else median_price * value
+    
+    @staticmethod
+    def hash_prices(prices: List[dict]) -> int:
+        """Hash the timestamp/price pairs of a price list"""
+        return hash(tuple((p['timestamp'], p['price']) for p in prices))
+    
+    def calculate_timeframes(self, prices: List[dict]) -> None:
+        """Calculate efficient timeframes for all devices from a list of price entries"""
+        self._prices_hash = self.hash_prices(prices)
+        self._timeframes_version = web_app.config_version
+        
+        # Build the numeric arrays once and share them across all devices
+        prices_arr = np.fromiter((p['price'] for p in prices), dtype=np.float64, count=len(prices))
+        ts_arr = np.fromiter((p['timestamp'] for p in prices), dtype=np.int64, count=len(prices))
         
-        if threshold_config['type'] == 'fixed':
-            return threshold_config['value']
-        else:  # multiplier
-            return median_price * threshold_config['value']
+        # Calculate median price from all available prices
+        median_price = float(np.median(prices_arr))
+        self.last_prices = prices
+        self.last_price_values = prices_arr
+        logger.info(f"Median price: {median_price:.2f} senti/kWh")
+        
+        # Calculate timeframes for each device individually
+        self.price_timeframes = {}
+        self._timeframe_starts = {}
+        self._timeframe_ends = {}
+        devices_snapshot = web_app.snapshot()
+        self.normalize_thresholds(devices_snapshot)
+        for device_name, _ in devices_snapshot:
+            threshold_price = self.calculate_threshold_price(device_name, median_price)
+            
+            # Pass threshold_price directly to efficient_timeframes
+            timeframes = efficient_timeframes(prices_arr, ts_arr, threshold_price)
+            self.price_timeframes[device_name] = timeframes
+            self._timeframe_starts[device_name] = [start for start, _, _, _ in timeframes]
+            self._timeframe_ends[device_name] = [end for _, end, _, _ in timeframes]
+            
+            is_fixed, value = self._norm_thresholds.get(device_name, DEFAULT_THRESHOLD)
+            if is_fixed:
+                logger.info(f"Device {device_name} (fixed {threshold_price:.2f} s/kWh): {len(timeframes)} periods found")
+            else:
+                logger.info(f"Device {device_name} ({value:.2f}× median): {len(timeframes)} periods found")
+            
+            if timeframes and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("\n".join(
+                    f"  {start.isoformat(sep=' ', timespec='minutes')} - {end.strftime('%H:%M')} ({duration}min, avg {avg:.2f} senti/kWh)"
+                    for start, end, avg, duration in timeframes
+                ))
+        
+        # Timeframes changed, so the control loop's next boundary may have moved
+        self._wake.set()
     
     async def update_prices(self) -> None:
         """Fetch prices and calculate efficient timeframes for all devices"""
         logger.info("Fetching electricity prices...")
-        prices = fetch_electricity_prices()
+        # requests is blocking, so fetch in a worker thread to keep the event loop responsive
+        prices = await asyncio.to_thread(fetch_electricity_prices)
         if prices:
-            self.last_prices = prices
             logger.info(f"Received {len(prices)} price entries")
             
-            # Calculate median price from all available prices
-            import statistics
-            price_values = [p['price'] for p in prices]
-            median_price = statistics.median(price_values)
-            logger.info(f"Median price: {median_price:.2f} senti/kWh")
+            # Skip recalculating when neither the prices nor the device configuration changed
+            if self.hash_prices(prices) == self._prices_hash and web_app.config_version == self._timeframes_version:
+                logger.info("Prices and device configuration unchanged, keeping existing timeframes")
+                return
             
-            # Calculate timeframes for each device individually
-            self.price_timeframes = {}
-            for device_name in web_app.devices.keys():
-                threshold_price = self.calculate_threshold_price(device_name, median_price)
-                
-                # Pass threshold_price directly to efficient_timeframes
-                timeframes = efficient_timeframes(prices, threshold_price)
-                self.price_timeframes[device_name] = timeframes
-                
-                # Get threshold config for logging (already validated in calculate_threshold_price)
-                threshold_config = web_app.device_thresholds.get(device_name, {'type': 'multiplier', 'value': web_app.DEFAULT_THRESHOLD_MULTIPLIER})
-                if threshold_config['type'] == 'fixed':
-                    logger.info(f"Device {device_name} (fixed {threshold_price:.2f} s/kWh): {len(timeframes)} periods found")
-                else:
-                    logger.info(f"Device {device_name} ({threshold_config['value']:.2f}× median): {len(timeframes)} periods found")
-                
-                for start, end, avg, duration in timeframes:
-                    logger.debug(f"  {start.strftime('%Y-%m-%d %H:%M')} - {end.strftime('%H:%M')} ({duration}min, avg {avg:.2f} senti/kWh)")
+            self.calculate_timeframes(prices)
+            self.save_price_cache(prices)
         else:
             logger.error("Failed to fetch electricity prices")
     
-    def should_be_on_for_device(self, device_name: str, current_time: datetime) -> bool:
-        """Check if current time is within any efficient timeframe for a specific device"""
-        if current_time.tzinfo is not None:
-            current_time = current_time.replace(tzinfo=None)
+    def save_price_cache(self, prices: List[dict]) -> None:
+        """Save the latest prices to disk so a restart can use them before the first fetch"""
+        try:
+            with open(PRICES_CACHE_FILE, 'w') as f:
+                f.write(json.dumps({'fetched_at': time.time(), 'prices': prices}, separators=(',', ':')))
+            logger.debug(f"Prices cached to {PRICES_CACHE_FILE}")
+        except Exception as e:
+            logger.error(f"Error saving price cache: {e}")
+    
+    def load_price_cache(self) -> bool:
+        """Load previously fetched prices from disk and calculate timeframes from them; returns True if they cover the current time"""
+        if not os.path.exists(PRICES_CACHE_FILE):
+            return False
+        try:
+            with open(PRICES_CACHE_FILE, 'r') as f:
+                prices = json.load(f).get('prices', [])
+        except Exception as e:
+            logger.error(f"Error loading price cache: {e}")
+            return False
+        if not prices:
+            return False
         
-        timeframes = self.price_timeframes.get(device_name, [])
+        logger.info(f"Loaded {len(prices)} cached price entries from {PRICES_CACHE_FILE}")
+        self.calculate_timeframes(prices)
+        # Each entry covers a 15 minute slot starting at its timestamp
+        return prices[-1]['timestamp'] + 900 > time.time()
+    
+    def should_be_on_for_device(self, device_name: str, current_time: datetime) -> bool:
+        """Check if current time (naive local time) is within any efficient timeframe for a specific device"""
+        starts = self._timeframe_starts.get(device_name)
+        if not starts:
+            return False
         
-        for start, end, _, _ in timeframes:
-            if start <= current_time < end:
-                return True
-        return False
+        # Timeframes are sorted and non-overlapping, so only the last one starting before now can match
+        idx = bisect.bisect_right(starts, current_time) - 1
+        return idx >= 0 and current_time < self._timeframe_ends[device_name][idx]
+    
+    def seconds_until_next_boundary(self, current_time: datetime) -> float:
+        """Seconds until the next timeframe start or end across all devices, capped at max_idle"""
+        wait = self.max_idle
+        for device_name, starts in self._timeframe_starts.items():
+            for boundaries in (starts, self._timeframe_ends[device_name]):
+                idx = bisect.bisect_right(boundaries, current_time)
+                if idx < len(boundaries):
+                    wait = min(wait, (boundaries[idx] - current_time).total_seconds())
+        return wait
+    
+    def wake(self) -> None:
+        """Ask the control loop to re-check devices now (safe to call from other threads)"""
+        self.loop.call_soon_threadsafe(self._wake.set)
     
     def get_timeframes_for_threshold(self, device_name: str) -> List[Tuple[datetime, datetime, float, int]]:
         """Get timeframes for a specific device"""
@@ -91,72 +198,91 @@ class DeviceScheduler:
     
     async def test_device_connection(self, ip: str) -> bool:
         """Test if a device can be reached (for validation)"""
-        try:
-            device = await self.get_device(ip)
-            await device.get_device_info()
-            logger.debug(f"Device connection test successful for {ip}")
-            return True
-        except Exception as e:
-            logger.warning(f"Device connection test failed for {ip}: {e}")
-            return False
-    
-    async def get_device_state(self, name: str, ip: str) -> Optional[bool]:
-        """Get device state with retry logic"""
-        for attempt in range(self.max_retries):
+        async with self._device_locks[ip]:
             try:
                 device = await self.get_device(ip)
-                device_info = await device.get_device_info()
-                logger.debug(f"Got state for {name}: {'ON' if device_info.device_on else 'OFF'}")
-                return device_info.device_on
+                await device.get_device_info()
+                logger.debug(f"Device connection test successful for {ip}")
+                return True
             except Exception as e:
-                if attempt < self.max_retries - 1:
-                    wait_time = self.retry_delay * (2 ** attempt)
-                    logger.warning(f"Error getting {name} state (attempt {attempt + 1}/{self.max_retries}): {e}")
-                    logger.info(f"Retrying in {wait_time:.1f}s...")
-                    await asyncio.sleep(wait_time)
-                else:
-                    logger.error(f"Failed to get {name} state after {self.max_retries} attempts: {e}")
-                    return None
-        return None
+                self._devices.pop(ip, None)
+                logger.warning(f"Device connection test failed for {ip}: {e}")
+                return False
+    
+    async def get_device_state(self, name: str, ip: str) -> Optional[bool]:
+        """Get device state with retry logic"""
+        async with self._device_locks[ip]:
+            cached = self._state_cache.get(ip)
+            if cached is not None and time.monotonic() - cached[0] < self.state_ttl:
+                return cached[1]
+            
+            for attempt in range(self.max_retries):
+                try:
+                    device = await self.get_device(ip)
+                    device_info = await device.get_device_info()
+                    logger.debug(f"Got state for {name}: {'ON' if device_info.device_on else 'OFF'}")
+                    self._state_cache[ip] = (time.monotonic(), device_info.device_on)
+                    return device_info.device_on
+                except Exception as e:
+                    self._state_cache.pop(ip, None)
+                    # Drop the cached connection so the next attempt reconnects
+                    self._devices.pop(ip, None)
+                    if attempt < self.max_retries - 1:
+                        wait_time = self._backoff(attempt)
+                        logger.warning(f"Error getting {name} state (attempt {attempt + 1}/{self.max_retries}): {e}")
+                        logger.info(f"Retrying in {wait_time:.1f}s...")
+                        await asyncio.sleep(wait_time)
+                    else:
+                        logger.error(f"Failed to get {name} state after {self.max_retries} attempts: {e}")
+                        return None
+            return None
     
     async def set_device_state(self, name: str, ip: str, turn_on: bool) -> bool:
         """Set device state with retry logic"""
         action_name = "ON" if turn_on else "OFF"
         
-        for attempt in range(self.max_retries):
+        async with self._device_locks[ip]:
+            for attempt in range(self.max_retries):
+                try:
+                    device = await self.get_device(ip)
+                    if turn_on:
+                        await device.on()
+                    else:
+                        await device.off()
+                    logger.info(f"{datetime.now().strftime('%H:%M:%S')} - Turned {action_name} {name}")
+                    self._state_cache[ip] = (time.monotonic(), turn_on)
+                    return True
+                except Exception as e:
+                    self._state_cache.pop(ip, None)
+                    # Drop the cached connection so the next attempt reconnects
+                    self._devices.pop(ip, None)
+                    if attempt < self.max_retries - 1:
+                        wait_time = self._backoff(attempt)
+                        logger.warning(f"Error turning {action_name} {name} (attempt {attempt + 1}/{self.max_retries}): {e}")
+                        logger.info(f"Retrying in {wait_time:.1f}s...")
+                        await asyncio.sleep(wait_time)
+                    else:
+                        logger.error(f"Failed to turn {action_name} {name} after {self.max_retries} attempts: {e}")
+                        return False
+            return False
+    
+    async def probe_all(self, items: List[Tuple[str, str]], timeout: float) -> List[Optional[bool]]:
+        """Get the states of several devices concurrently; unreachable or slow devices give None"""
+        async def _probe(name: str, ip: str) -> Optional[bool]:
             try:
-                device = await self.get_device(ip)
-                if turn_on:
-                    await device.on()
-                else:
-                    await device.off()
-                logger.info(f"{datetime.now().strftime('%H:%M:%S')} - Turned {action_name} {name}")
-                return True
-            except Exception as e:
-                if attempt < self.max_retries - 1:
-                    wait_time = self.retry_delay * (2 ** attempt)
-                    logger.warning(f"Error turning {action_name} {name} (attempt {attempt + 1}/{self.max_retries}): {e}")
-                    logger.info(f"Retrying in {wait_time:.1f}s...")
-                    await asyncio.sleep(wait_time)
-                else:
-                    logger.error(f"Failed to turn {action_name} {name} after {self.max_retries} attempts: {e}")
-                    return False
-        return False
-    
-    async def manage_devices(self) -> None:
-        """Check and update device states based on timeframes"""
+                return await asyncio.wait_for(self.get_device_state(name, ip), timeout)
+            except Exception:
+                return None
+        
+        return await asyncio.gather(*[_probe(name, ip) for name, ip in items])
+    
+    async def manage_devices(self) -> bool:
+        """Check and update device states based on timeframes; returns False if any device could not be read or set"""
         current_time: datetime = datetime.now()
         
-        devices_snapshot = dict(web_app.devices.items())
+        devices_snapshot = web_app.snapshot()
         
-        for name, ip in devices_snapshot.items():
-            # Skip if device was deleted during iteration
-            if name not in web_app.devices:
-                continue
-                
-            # Check if device has a forced state
-            forced_state = web_app.forced_states.get(name)
-            
+        async def _handle(name: str, ip: str, forced_state: Optional[bool]) -> bool:
             if forced_state is not None:
                 # Device is in forced mode
                 target_state = forced_state
@@ -167,12 +293,28 @@ class DeviceScheduler:
             is_on = await self.get_device_state(name, ip)
             
             if is_on is None:
-                continue
+                return False
             
-            if target_state and not is_on:
-                await self.set_device_state(name, ip, True)
-            elif not target_state and is_on:
-                await self.set_device_state(name, ip, False)
+            if target_state != is_on:
+                return await self.set_device_state(name, ip, target_state)
+            return True
+        
+        tasks = [_handle(name, record.ip, record.forced_state) for name, record in devices_snapshot]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        all_ok = True
+        for (name, _), result in zip(devices_snapshot, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error managing {name}: {result}")
+                all_ok = False
+            elif not result:
+                all_ok = False
+        return all_ok
+    
+    async def refresh_and_manage(self) -> None:
+        """Recalculate timeframes, then apply device states against them"""
+        await self.update_prices()
+        await self.manage_devices()
     
     async def price_update_loop(self) -> None:
         """Update prices every 4 hours"""
@@ -184,10 +326,20 @@ class DeviceScheduler:
             await asyncio.sleep(wait_seconds)
     
     async def device_control_loop(self) -> None:
-        """Check device states every minute"""
+        """Check device states at timeframe boundaries, or earlier when woken"""
         while True:
-            await self.manage_devices()
-            await asyncio.sleep(60)
+            self._wake.clear()
+            all_ok = await self.manage_devices()
+            
+            # Sleep until just past the next boundary unless a config change wakes us first
+            timeout = self.seconds_until_next_boundary(datetime.now()) + 1
+            if not all_ok:
+                # Retry unreachable devices soon instead of leaving them in the wrong state until the next boundary
+                timeout = min(timeout, self.failure_retry_interval)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
 
 async def main() -> None:
     # Configure logging
@@ -224,20 +376,24 @@ async def main() -> None:
     web_app.scheduler = scheduler
     
     # Get the event loop
-    scheduler.loop = asyncio.get_event_loop()
+    scheduler.loop = asyncio.get_running_loop()
     
-    # Start web server
-    web_app.start_web_server()
+    # Start web server on this event loop
+    web_task = web_app.start_web_server()
     
     logger.info("Device scheduler started")
     
-    # Initial price fetch
-    await scheduler.update_prices()
+    # Start from cached prices; price_update_loop fetches fresh ones in the background
+    if not scheduler.load_price_cache():
+        # Without current prices the control loop would switch every auto-mode device off until the fetch lands
+        logger.info("No usable cached prices, fetching before starting device control")
+        await scheduler.update_prices()
     
-    # Run both loops concurrently
+    # Run both loops and the web server concurrently
     await asyncio.gather(
         scheduler.price_update_loop(),
-        scheduler.device_control_loop()
+        scheduler.device_control_loop(),
+        web_task
     )
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import requests
 from datetime import datetime, timedelta, timezone
-import statistics
 import logging
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -9,6 +9,7 @@ def fetch_electricity_prices():
     """
     Fetch electricity prices for Estonia from Elering API
     Returns list of price data for today and tomorrow with prices in senti/kWh
+    and a preformatted local 'time' string for each entry
     """
     url = "https://dashboard.elering.ee/api/nps/price"
     
@@ -24,13 +25,14 @@ def fetch_electricity_prices():
     logger.debug(f"Fetching electricity prices from {params['start']} to {params['end']}")
     
     try:
-        response = requests.get(url, params=params)
+        response = requests.get(url, params=params, timeout=10)
         response.raise_for_status()
         data = response.json()
         
         ee_prices = data.get('data', {}).get('ee', [])
         for price_data in ee_prices:
             price_data['price'] = price_data['price'] / 10
+            price_data['time'] = datetime.fromtimestamp(price_data['timestamp']).isoformat(sep=' ', timespec='minutes')
         
         logger.info(f"Successfully fetched {len(ee_prices)} price entries")
         return ee_prices
@@ -58,62 +60,67 @@ def get_price_statistics(prices):
     if not prices:
         return None
     
-    price_values = [p['price'] for p in prices]
+    price_values = np.fromiter((p['price'] for p in prices), dtype=np.float64, count=len(prices))
     return {
-        'min': min(price_values),
-        'max': max(price_values),
-        'mean': statistics.mean(price_values),
-        'median': statistics.median(price_values)
+        'min': float(price_values.min()),
+        'max': float(price_values.max()),
+        'mean': float(price_values.mean()),
+        'median': float(np.median(price_values))
     }
 
-def efficient_timeframes(prices, threshold_price, min_duration_minutes=0):
+def efficient_timeframes(prices_arr, ts_arr, threshold_price, min_duration_minutes=0):
     """
     Get timeframes where the price is below a threshold
     Groups consecutive cheap slots and filters by minimum duration
     
     Args:
-        prices: List of price data
+        prices_arr: NumPy array of 15-minute slot prices in senti/kWh
+        ts_arr: NumPy array of slot start timestamps, aligned with prices_arr
         threshold_price: Fixed threshold price in senti/kWh
         min_duration_minutes: Minimum consecutive duration to include a timeframe (default 0)
     
     Returns:
         List of tuples (start_time, end_time, avg_price, duration_minutes)
     """
-    if not prices:
+    if len(prices_arr) == 0:
         return []
     
     # Determine threshold price
     threshold = threshold_price
     logger.debug(f"Using fixed threshold={threshold:.2f} senti/kWh")
     
-    # Mark slots as cheap or expensive
-    is_cheap = [p['price'] < threshold for p in prices]
+    # Mark slots as cheap and find the boundaries of consecutive cheap runs
+    is_cheap = prices_arr < threshold
+    edges = np.flatnonzero(np.diff(np.r_[False, is_cheap, False]))
+    starts, ends = edges[0::2], edges[1::2]
+    
+    # Average price of each run from prefix sums
+    cumulative = np.r_[0.0, np.cumsum(prices_arr)]
+    lengths = ends - starts
+    avg_prices = (cumulative[ends] - cumulative[starts]) / lengths
+    
+    # Convert run boundaries to plain Python values in one batch
+    start_stamps = ts_arr[starts].tolist()
+    end_stamps = (ts_arr[ends - 1] + 900).tolist()
     
-    # Group consecutive cheap periods
     all_timeframes = []
-    i = 0
-    while i < len(prices):
-        if is_cheap[i]:
-            start_idx = i
-            frame_prices = []
-            
-            # Collect consecutive cheap slots
-            while i < len(prices) and is_cheap[i]:
-                frame_prices.append(prices[i]['price'])
-                i += 1
-            
-            start_time = datetime.fromtimestamp(prices[start_idx]['timestamp'])
-            end_time = datetime.fromtimestamp(prices[i-1]['timestamp']) + timedelta(minutes=15)
-            avg_price = statistics.mean(frame_prices)
-            duration_minutes = len(frame_prices) * 15
-            
-            # Only include if duration meets minimum requirement
-            if duration_minutes >= min_duration_minutes:
-                all_timeframes.append((start_time, end_time, avg_price, duration_minutes))
-            else:
-                logger.debug(f"Skipping timeframe {start_time.strftime('%H:%M')}-{end_time.strftime('%H:%M')} (duration {duration_minutes}min < {min_duration_minutes}min)")
+    skipped = []
+    for start_ts, end_ts, avg_price, length in zip(start_stamps, end_stamps, avg_prices.tolist(), lengths.tolist()):
+        start_time = datetime.fromtimestamp(start_ts)
+        end_time = datetime.fromtimestamp(end_ts)
+        duration_minutes = length * 15
+        
+        # Only include if duration meets minimum requirement
+        if duration_minutes >= min_duration_minutes:
+            all_timeframes.append((start_time, end_time, avg_price, duration_minutes))
         else:
-            i += 1
+            skipped.append((start_time, end_time, duration_minutes))
+    
+    if skipped and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("\n".join(
+            f"Skipping timeframe {start.strftime('%H:%M')}-{end.strftime('%H:%M')} (duration {duration}min < {min_duration_minutes}min)"
+            for start, end, duration in skipped
+        ))
 
     logger.debug(f"Found {len(all_timeframes)} timeframes meeting minimum duration of {min_duration_minutes} minutes")
     return all_timeframes
@@ -140,7 +147,9 @@ if __name__ == "__main__":
         print(f"  Median: {stats['median']:.2f} senti/kWh")
         
         threshold_price = stats['median'] * 1.2
-        efficient = efficient_timeframes(prices, threshold_price=threshold_price)
+        prices_arr = np.fromiter((p['price'] for p in prices), dtype=np.float64, count=len(prices))
+        ts_arr = np.fromiter((p['timestamp'] for p in prices), dtype=np.int64, count=len(prices))
+        efficient = efficient_timeframes(prices_arr, ts_arr, threshold_price=threshold_price)
         print(f"\nEfficient timeframes (below {threshold_price:.2f} senti/kWh, min 30min):")
         for start, end, avg, duration in efficient:
             print(f"  {start.strftime('%H:%M')} - {end.strftime('%H:%M')} ({duration}min): Avg {avg:.2f} senti/kWh")
@@ -1,115 +1,241 @@
-from flask import Flask, render_template, request, jsonify
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from quart import Quart, render_template, request
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 import json
 import os
 import asyncio
-from threading import Thread
-import statistics
+import atexit
+import bisect
+import functools
+import time
+from threading import Event, Lock, Thread
 import logging
-from waitress import serve
+import numpy as np
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Quart(__name__)
+
+def _dumps(obj) -> bytes:
+    """Serialize obj to compact JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def _loads(data):
+    """Parse JSON from bytes or str, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_response(body: bytes):
+    """Wrap already serialized JSON bytes in a response"""
+    return app.response_class(body, mimetype='application/json')
+
+def ojson(obj):
+    """Build a JSON response (replacement for flask.jsonify)"""
+    return _json_response(_dumps(obj))
 
 # Configuration file path
 CONFIG_FILE = "config.json"
+# Seconds to wait after a change before writing the config, so bursts of changes are written once
+CONFIG_SAVE_DELAY = 0.5
+# Seconds a computed /api/status response is reused
+STATUS_CACHE_TTL = 1.5
+# Number of prices encoded per chunk when streaming /api/prices
+PRICES_STREAM_BATCH = 48
 # Default threshold values
 DEFAULT_THRESHOLD_MULTIPLIER = 1.5
+# Valid values of DeviceRecord.threshold_type
+THRESHOLD_TYPES = ('multiplier', 'fixed')
+
+class DeviceRecord:
+    """Configuration and forced state of a single device"""
+    __slots__ = ('ip', 'threshold_type', 'threshold_value', 'forced_state')
+    
+    def __init__(self, ip: str, threshold_type: str = 'multiplier',
+                 threshold_value: float = DEFAULT_THRESHOLD_MULTIPLIER, forced_state: Optional[bool] = None) -> None:
+        self.ip = ip
+        self.threshold_type = threshold_type  # 'multiplier' or 'fixed'
+        self.threshold_value = threshold_value
+        self.forced_state = forced_state  # None = auto, True = force on, False = force off
+    
+    def copy(self) -> 'DeviceRecord':
+        return DeviceRecord(self.ip, self.threshold_type, self.threshold_value, self.forced_state)
 
 # Global state
-devices: Dict[str, str] = {}
-device_thresholds: Dict[str, dict] = {}  # Per-device threshold config: {type: 'multiplier'|'fixed', value: float}
-forced_states: Dict[str, Optional[bool]] = {}  # None = auto, True = force on, False = force off
+devices: Dict[str, DeviceRecord] = {}
 scheduler = None
+config_version = 0  # Bumped when the device set or thresholds change; keys the scheduler's cached timeframes
+devices_version = 0  # Bumped on every device configuration change, forced states included; keys the /api/devices response
+_state_lock = Lock()  # Guards the state dicts against the config writer thread reading them mid-update
+_config_dirty = Event()  # Set when the config has unsaved changes
+_save_lock = Lock()  # Serializes config file writes
+_status_cache = {'t': 0.0, 'done': 0.0, 'valid_after': 0.0, 'body': None}  # Last /api/status response and when its build started and finished
+_status_lock = asyncio.Lock()  # Lets only one request compute the status at a time
+_background_tasks = set()  # Keeps fire-and-forget scheduler tasks alive until they finish
+_prices_cache = {'prices': None, 'minute': None, 'body': None}  # Last /api/prices response and what it was built from
+_timeframes_cache: Dict[str, Tuple[list, List[dict]]] = {}  # Device name -> (timeframes, their /api/status rendering)
+
+def _invalidate_status() -> None:
+    """Discard the cached /api/status response so the next request sees fresh data"""
+    _status_cache['valid_after'] = time.monotonic()
+
+async def _body() -> Optional[dict]:
+    """Parse the JSON request body; an empty body gives an empty dict, invalid or non-object bodies give None"""
+    raw = await request.get_data()
+    if not raw:
+        return {}
+    try:
+        data = _loads(raw)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def _spawn(coro) -> None:
+    """Run a coroutine in the background without waiting for it"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def snapshot() -> List[Tuple[str, DeviceRecord]]:
+    """Return a consistent list of (name, record) for all devices, with records copied"""
+    with _state_lock:
+        return [(name, record.copy()) for name, record in devices.items()]
 
 def load_config() -> None:
     """Load configuration from file"""
-    global devices, device_thresholds, forced_states
+    global devices, config_version, devices_version
     
     if os.path.exists(CONFIG_FILE):
         logger.info(f"Loading configuration from {CONFIG_FILE}")
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-                devices = config.get('devices', {})
-                device_thresholds_raw = config.get('device_thresholds', {})
-                forced_states = config.get('forced_states', {})
-                
-                device_thresholds = {}
-                for name in devices:
-                    if name in device_thresholds_raw:
-                        threshold_data = device_thresholds_raw[name]
-                        if isinstance(threshold_data, dict):
-                            device_thresholds[name] = threshold_data
-                        else:
-                            logger.warning(f"Device {name} has invalid threshold data type, using default (multiplier: {DEFAULT_THRESHOLD_MULTIPLIER})")
-                            device_thresholds[name] = {'type': 'multiplier', 'value': DEFAULT_THRESHOLD_MULTIPLIER}
-                    else:
-                        logger.warning(f"Device {name} missing threshold configuration in config file, using default (multiplier: {DEFAULT_THRESHOLD_MULTIPLIER})")
-                        device_thresholds[name] = {'type': 'multiplier', 'value': DEFAULT_THRESHOLD_MULTIPLIER}
-                    
-                    if name not in forced_states:
-                        forced_states[name] = None
+            with open(CONFIG_FILE, 'rb') as f:
+                config = _loads(f.read())
+            device_ips = config.get('devices', {})
+            device_thresholds_raw = config.get('device_thresholds', {})
+            forced_states_raw = config.get('forced_states', {})
+            
+            # Every device gets a threshold config here, so the rest of the app can rely on it
+            loaded = {}
+            backfilled = []
+            for name, ip in device_ips.items():
+                record = DeviceRecord(ip, forced_state=forced_states_raw.get(name))
+                threshold_data = device_thresholds_raw.get(name)
+                if (isinstance(threshold_data, dict)
+                        and threshold_data.get('type') in THRESHOLD_TYPES
+                        and 'value' in threshold_data):
+                    record.threshold_type = threshold_data['type']
+                    record.threshold_value = threshold_data['value']
+                else:
+                    backfilled.append(name)
+                loaded[name] = record
+            devices = loaded
+            
+            if backfilled:
+                logger.warning("Missing or invalid threshold configuration for %s, using default (multiplier: %s)",
+                               ', '.join(backfilled), DEFAULT_THRESHOLD_MULTIPLIER)
             
             logger.info(f"Loaded {len(devices)} devices from configuration")
         except Exception as e:
             logger.error(f"Error loading config: {e}")
             devices = {}
-            device_thresholds = {}
-            forced_states = {}
     else:
         # Default configuration
         logger.info("No config file found, creating default configuration")
         devices = {}
-        device_thresholds = {}
-        forced_states = {}
         save_config()
+    
+    config_version += 1
+    devices_version += 1
 
 def save_config() -> None:
+    """Mark configuration as changed; the config writer thread saves it shortly after"""
+    _config_dirty.set()
+
+def _write_config() -> None:
     """Save configuration to file"""
-    config = {
-        'devices': devices,
-        'device_thresholds': device_thresholds,
-        'forced_states': forced_states
-    }
-    try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=2)
-        logger.debug(f"Configuration saved to {CONFIG_FILE}")
-    except Exception as e:
-        logger.error(f"Error saving config: {e}")
+    # Keep the on-disk layout of separate devices/thresholds/forced_states maps
+    with _state_lock:
+        config = {
+            'devices': {name: record.ip for name, record in devices.items()},
+            'device_thresholds': {
+                name: {'type': record.threshold_type, 'value': record.threshold_value}
+                for name, record in devices.items()
+            },
+            'forced_states': {name: record.forced_state for name, record in devices.items()}
+        }
+    with _save_lock:
+        try:
+            # Write to a temp file and swap it in, so a crash never leaves a truncated config behind
+            tmp_file = CONFIG_FILE + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(_dumps(config))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, CONFIG_FILE)
+            logger.debug(f"Configuration saved to {CONFIG_FILE}")
+        except Exception as e:
+            logger.error(f"Error saving config: {e}")
+
+def _config_writer() -> None:
+    """Write the config whenever it is marked changed, coalescing changes made within CONFIG_SAVE_DELAY"""
+    while True:
+        _config_dirty.wait()
+        time.sleep(CONFIG_SAVE_DELAY)
+        _config_dirty.clear()
+        _write_config()
+
+@atexit.register
+def flush_config() -> None:
+    """Write any pending configuration changes immediately"""
+    if _config_dirty.is_set():
+        _config_dirty.clear()
+        _write_config()
+
+def start_config_writer() -> None:
+    """Start the background config writer thread"""
+    Thread(target=_config_writer, daemon=True).start()
 
 @app.route('/')
-def index():
+async def index():
     """Serve the main page"""
-    return render_template('index.html')
+    return await render_template('index.html')
 
 @app.route('/api/devices', methods=['GET'])
-def get_devices():
+async def get_devices():
     """Get all devices"""
+    return _json_response(_render_devices(devices_version))
+
+@functools.lru_cache(maxsize=2)
+def _render_devices(version: int) -> bytes:
+    """Serialize the device list; cached per devices_version"""
     device_list = []
-    for name, ip in devices.items():
-        if name not in device_thresholds:
-            logger.warning(f"Device {name} missing threshold configuration, using default (multiplier: {DEFAULT_THRESHOLD_MULTIPLIER})")
-            threshold_config = {'type': 'multiplier', 'value': DEFAULT_THRESHOLD_MULTIPLIER}
-        else:
-            threshold_config = device_thresholds[name]
-        
+    for name, record in devices.items():
         device_list.append({
             'name': name,
-            'ip': ip,
-            'threshold_type': threshold_config['type'],
-            'threshold_value': threshold_config['value'],
-            'forced_state': forced_states.get(name)
+            'ip': record.ip,
+            'threshold_type': record.threshold_type,
+            'threshold_value': record.threshold_value,
+            'forced_state': record.forced_state
         })
-    return jsonify({'devices': device_list})
+    return _dumps({'devices': device_list})
 
 @app.route('/api/devices', methods=['POST'])
-def add_device():
+async def add_device():
     """Add a new device"""
-    data = request.json
+    global config_version, devices_version
+    data = await _body()
+    if data is None:
+        logger.warning(f"Add device failed: invalid JSON body")
+        return ojson({'error': 'Invalid JSON body'}), 400
     name = data.get('name', '').strip()
     ip = data.get('ip', '').strip()
     threshold_type = data.get('threshold_type', 'multiplier')
@@ -119,277 +245,336 @@ def add_device():
     
     if not name or not ip:
         logger.warning(f"Add device failed: missing name or IP")
-        return jsonify({'error': 'Name and IP are required'}), 400
+        return ojson({'error': 'Name and IP are required'}), 400
     
     if name in devices:
         logger.warning(f"Add device failed: {name} already exists")
-        return jsonify({'error': 'Device with this name already exists'}), 400
+        return ojson({'error': 'Device with this name already exists'}), 400
     
-    if threshold_type not in ['multiplier', 'fixed']:
+    if threshold_type not in THRESHOLD_TYPES:
         logger.warning(f"Add device failed: invalid threshold type {threshold_type}")
-        return jsonify({'error': 'Threshold type must be "multiplier" or "fixed"'}), 400
+        return ojson({'error': 'Threshold type must be "multiplier" or "fixed"'}), 400
     
     try:
         threshold_value = float(threshold_value)
         if threshold_value <= 0:
             logger.warning(f"Add device failed: threshold value must be positive")
-            return jsonify({'error': 'Threshold must be positive'}), 400
+            return ojson({'error': 'Threshold must be positive'}), 400
     except (TypeError, ValueError):
         logger.warning(f"Add device failed: invalid threshold value")
-        return jsonify({'error': 'Invalid threshold value'}), 400
+        return ojson({'error': 'Invalid threshold value'}), 400
     
     # Validate device connection if scheduler is available
     if scheduler:
         try:
             logger.debug(f"Testing connection to {name} at {ip}")
-            # Test connection asynchronously
-            future = asyncio.run_coroutine_threadsafe(
-                scheduler.test_device_connection(ip), 
-                scheduler.loop
-            )
             # Wait up to 5 seconds for connection test
-            connection_ok = future.result(timeout=5)
+            connection_ok = await asyncio.wait_for(scheduler.test_device_connection(ip), timeout=5)
             if not connection_ok:
                 logger.warning(f"Add device failed: cannot connect to {ip}")
-                return jsonify({'error': 'Cannot connect to device. Please check IP address and network.'}), 400
+                return ojson({'error': 'Cannot connect to device. Please check IP address and network.'}), 400
             logger.info(f"Connection test successful for {name}")
         except Exception as e:
             logger.error(f"Connection test exception for {name}: {e}")
-            return jsonify({'error': f'Connection test failed: {str(e)}'}), 400
+            return ojson({'error': f'Connection test failed: {str(e)}'}), 400
     
-    devices[name] = ip
-    device_thresholds[name] = {'type': threshold_type, 'value': threshold_value}
-    forced_states[name] = None
+    with _state_lock:
+        devices[name] = DeviceRecord(ip, threshold_type, threshold_value)
+        config_version += 1
+        devices_version += 1
     save_config()
     
     # Trigger price update to calculate timeframes for the new device
     if scheduler:
         logger.info(f"Triggering price update for new device {name}")
-        asyncio.run_coroutine_threadsafe(scheduler.update_prices(), scheduler.loop)
-        # Immediately check device state
-        asyncio.run_coroutine_threadsafe(scheduler.manage_devices(), scheduler.loop)
+        _spawn(scheduler.refresh_and_manage())
     
+    _invalidate_status()
     logger.info(f"Device {name} added successfully")
-    return jsonify({'success': True, 'message': f'Device {name} added'})
+    return ojson({'success': True, 'message': f'Device {name} added'})
 
 @app.route('/api/devices/<name>', methods=['PUT'])
-def update_device(name):
+async def update_device(name):
     """Update device IP and/or threshold"""
+    global config_version, devices_version
     if name not in devices:
         logger.warning(f"Update device failed: {name} not found")
-        return jsonify({'error': 'Device not found'}), 404
+        return ojson({'error': 'Device not found'}), 404
     
-    data = request.json
+    data = await _body()
+    if data is None:
+        logger.warning(f"Update device failed: invalid JSON body")
+        return ojson({'error': 'Invalid JSON body'}), 400
     new_ip = data.get('ip', '').strip()
     new_threshold_type = data.get('threshold_type')
     new_threshold_value = data.get('threshold_value')
     
     logger.info(f"Updating device: {name}")
     
-    if new_ip:
+    # The device may have been deleted while the body was being read
+    with _state_lock:
+        record = devices.get(name)
+    if record is None:
+        logger.warning(f"Update device failed: {name} not found")
+        return ojson({'error': 'Device not found'}), 404
+    
+    # Work on a copy so a request that fails validation leaves the device untouched
+    updated = record.copy()
+    
+    changed = False
+    if new_ip and new_ip != updated.ip:
         logger.debug(f"Updating IP for {name}: {new_ip}")
-        devices[name] = new_ip
+        updated.ip = new_ip
+        changed = True
     
     threshold_changed = False
-    if new_threshold_type is not None or new_threshold_value is not None:
-        # Get current threshold config
-        if name not in device_thresholds:
-            logger.warning(f"Device {name} missing threshold configuration, using default (multiplier: {DEFAULT_THRESHOLD_MULTIPLIER})")
-            current_config = {'type': 'multiplier', 'value': DEFAULT_THRESHOLD_MULTIPLIER}
-        else:
-            current_config = device_thresholds[name]
-        
-        # Update type if provided
-        if new_threshold_type is not None:
-            if new_threshold_type not in ['multiplier', 'fixed']:
-                logger.warning(f"Update device failed: invalid threshold type {new_threshold_type}")
-                return jsonify({'error': 'Threshold type must be "multiplier" or "fixed"'}), 400
+    # Update type if provided
+    if new_threshold_type is not None:
+        if new_threshold_type not in THRESHOLD_TYPES:
+            logger.warning(f"Update device failed: invalid threshold type {new_threshold_type}")
+            return ojson({'error': 'Threshold type must be "multiplier" or "fixed"'}), 400
+        if new_threshold_type != updated.threshold_type:
             logger.debug(f"Updating threshold type for {name}: {new_threshold_type}")
-            current_config['type'] = new_threshold_type
+            updated.threshold_type = new_threshold_type
             threshold_changed = True
-        
-        # Update value if provided
-        if new_threshold_value is not None:
-            try:
-                new_threshold_value = float(new_threshold_value)
-                if new_threshold_value <= 0:
-                    logger.warning(f"Update device failed: threshold must be positive")
-                    return jsonify({'error': 'Threshold must be positive'}), 400
+    
+    # Update value if provided
+    if new_threshold_value is not None:
+        try:
+            new_threshold_value = float(new_threshold_value)
+            if new_threshold_value <= 0:
+                logger.warning(f"Update device failed: threshold must be positive")
+                return ojson({'error': 'Threshold must be positive'}), 400
+            if new_threshold_value != updated.threshold_value:
                 logger.debug(f"Updating threshold value for {name}: {new_threshold_value}")
-                current_config['value'] = new_threshold_value
+                updated.threshold_value = new_threshold_value
                 threshold_changed = True
-            except (TypeError, ValueError):
-                logger.warning(f"Update device failed: invalid threshold value")
-                return jsonify({'error': 'Invalid threshold value'}), 400
-        
-        device_thresholds[name] = current_config
+        except (TypeError, ValueError):
+            logger.warning(f"Update device failed: invalid threshold value")
+            return ojson({'error': 'Invalid threshold value'}), 400
+    
+    if not changed and not threshold_changed:
+        logger.info(f"Device {name} unchanged")
+        return ojson({'success': True, 'message': f'Device {name} updated'})
     
+    with _state_lock:
+        devices[name] = updated
+        devices_version += 1
+        # An IP change doesn't affect timeframes, so only a threshold change invalidates them
+        if threshold_changed:
+            config_version += 1
     save_config()
     
     # Trigger price update and device state check if threshold changed
     if threshold_changed and scheduler:
         logger.info(f"Threshold changed for {name}, triggering price update")
-        asyncio.run_coroutine_threadsafe(scheduler.update_prices(), scheduler.loop)
-        # Immediately check device states with new threshold
-        asyncio.run_coroutine_threadsafe(scheduler.manage_devices(), scheduler.loop)
-    
+        _spawn(scheduler.refresh_and_manage())
+    elif scheduler:
+        # Same thresholds, new IP: wake the control loop so the new plug gets its state right away
+        scheduler.wake()
+
+    _invalidate_status()
     logger.info(f"Device {name} updated successfully")
-    return jsonify({'success': True, 'message': f'Device {name} updated'})
+    return ojson({'success': True, 'message': f'Device {name} updated'})
 
 @app.route('/api/devices/<name>', methods=['DELETE'])
-def delete_device(name):
+async def delete_device(name):
     """Delete a device"""
+    global config_version, devices_version
     if name not in devices:
         logger.warning(f"Delete device failed: {name} not found")
-        return jsonify({'error': 'Device not found'}), 404
+        return ojson({'error': 'Device not found'}), 404
     
     logger.info(f"Deleting device: {name}")
-    del devices[name]
-    if name in device_thresholds:
-        del device_thresholds[name]
-    if name in forced_states:
-        del forced_states[name]
+    with _state_lock:
+        del devices[name]
+        config_version += 1
+        devices_version += 1
+    _timeframes_cache.pop(name, None)
     save_config()
     
+    _invalidate_status()
     logger.info(f"Device {name} deleted successfully")
-    return jsonify({'success': True, 'message': f'Device {name} deleted'})
+    return ojson({'success': True, 'message': f'Device {name} deleted'})
 
 @app.route('/api/devices/<name>/force', methods=['POST'])
-def force_device_state(name):
+async def force_device_state(name):
     """Force device on/off or set to auto"""
+    global devices_version
     if name not in devices:
         logger.warning(f"Force state failed: {name} not found")
-        return jsonify({'error': 'Device not found'}), 404
+        return ojson({'error': 'Device not found'}), 404
     
-    data = request.json
+    data = await _body()
+    if data is None:
+        logger.warning(f"Force state failed: invalid JSON body")
+        return ojson({'error': 'Invalid JSON body'}), 400
     state = data.get('state')  # 'on', 'off', or 'auto'
     
     logger.info(f"Setting device {name} to {state} mode")
     
-    if state == 'on':
-        forced_states[name] = True
-    elif state == 'off':
-        forced_states[name] = False
-    elif state == 'auto':
-        forced_states[name] = None
-    else:
+    if state not in ('on', 'off', 'auto'):
         logger.warning(f"Force state failed: invalid state {state}")
-        return jsonify({'error': 'Invalid state. Use "on", "off", or "auto"'}), 400
+        return ojson({'error': 'Invalid state. Use "on", "off", or "auto"'}), 400
+    
+    new_forced = {'on': True, 'off': False, 'auto': None}[state]
+    # The device may have been deleted while the body was being read
+    with _state_lock:
+        record = devices.get(name)
+    if record is None:
+        logger.warning(f"Force state failed: {name} not found")
+        return ojson({'error': 'Device not found'}), 404
+    if record.forced_state == new_forced:
+        logger.info(f"Device {name} already in {state} mode")
+        return ojson({'success': True, 'message': f'Device {name} set to {state}'})
+    
+    with _state_lock:
+        record.forced_state = new_forced
+        devices_version += 1
     
     save_config()
     
-    # Trigger immediate device check if scheduler is running
+    # Wake the control loop for an immediate device check if scheduler is running
     if scheduler:
-        asyncio.run_coroutine_threadsafe(scheduler.manage_devices(), scheduler.loop)
+        scheduler.wake()
     
+    _invalidate_status()
     logger.info(f"Device {name} set to {state} successfully")
-    return jsonify({'success': True, 'message': f'Device {name} set to {state}'})
+    return ojson({'success': True, 'message': f'Device {name} set to {state}'})
 
 @app.route('/api/threshold', methods=['GET'])
-def get_threshold():
+async def get_threshold():
     """Get threshold multiplier (deprecated - use per-device thresholds)"""
-    return jsonify({'threshold_multiplier': DEFAULT_THRESHOLD_MULTIPLIER, 'note': 'Use per-device thresholds instead'})
+    return ojson({'threshold_multiplier': DEFAULT_THRESHOLD_MULTIPLIER, 'note': 'Use per-device thresholds instead'})
 
 @app.route('/api/threshold', methods=['POST'])
-def update_threshold():
+async def update_threshold():
     """Update threshold multiplier (deprecated - use per-device thresholds)"""
-    return jsonify({'success': True, 'message': 'Use per-device thresholds instead'})
+    return ojson({'success': True, 'message': 'Use per-device thresholds instead'})
 
 @app.route('/api/status', methods=['GET'])
-def get_status():
+async def get_status():
     """Get current status of devices and timeframes"""
+    arrived = time.monotonic()
+    async with _status_lock:
+        # A build that finished while this request waited for the lock is as fresh as a new one
+        now = time.monotonic()
+        if (_status_cache['body'] is not None
+                and _status_cache['t'] > _status_cache['valid_after']
+                and (_status_cache['done'] >= arrived or now - _status_cache['done'] < STATUS_CACHE_TTL)):
+            return _json_response(_status_cache['body'])
+        
+        body = _dumps(await _build_status())
+        _status_cache['t'] = now
+        _status_cache['done'] = time.monotonic()
+        _status_cache['body'] = body
+    return _json_response(body)
+
+async def _build_status() -> dict:
+    """Collect current status of devices and timeframes"""
+    _sched = scheduler
+    _tf_cache = _timeframes_cache
+    now = datetime.now()
+    device_states_out = {}
+    timeframes_out = {}
     status = {
-        'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'device_states': {},
-        'timeframes': {}
+        'current_time': now.isoformat(sep=' ', timespec='seconds'),
+        'device_states': device_states_out,
+        'timeframes': timeframes_out
     }
     
-    if scheduler:
+    if _sched:
+        devices_snapshot = snapshot()
+        
+        # Check device connection status for all devices at once
+        try:
+            device_states = await _sched.probe_all([(name, record.ip) for name, record in devices_snapshot], timeout=3)
+        except Exception:
+            device_states = [None] * len(devices_snapshot)
+        
         # Get device states and timeframes per device
-        for name, ip in devices.items():
-            forced = forced_states.get(name)
-            
-            if name not in device_thresholds:
-                logger.warning(f"Device {name} missing threshold configuration in status check, using default (multiplier: {DEFAULT_THRESHOLD_MULTIPLIER})")
-                threshold_config = {'type': 'multiplier', 'value': DEFAULT_THRESHOLD_MULTIPLIER}
-            else:
-                threshold_config = device_thresholds[name]
-            
-            # Check device connection status
-            try:
-                future = asyncio.run_coroutine_threadsafe(
-                    scheduler.get_device_state(name, ip),
-                    scheduler.loop
-                )
-                device_state = future.result(timeout=3)
-                is_reachable = device_state is not None
-            except:
-                is_reachable = False
+        for (name, record), device_state in zip(devices_snapshot, device_states):
+            is_reachable = device_state is not None
+            forced = record.forced_state
             
-            status['device_states'][name] = {
+            device_states_out[name] = {
                 'forced_state': 'on' if forced is True else 'off' if forced is False else 'auto',
-                'threshold_type': threshold_config['type'],
-                'threshold_value': threshold_config['value'],
-                'should_be_on': scheduler.should_be_on_for_device(name, datetime.now()),
+                'threshold_type': record.threshold_type,
+                'threshold_value': record.threshold_value,
+                'should_be_on': _sched.should_be_on_for_device(name, now),
                 'is_reachable': is_reachable
             }
             
-            # Get timeframes for this device's threshold
-            device_timeframes = scheduler.get_timeframes_for_threshold(name)
-            status['timeframes'][name] = []
-            for start, end, avg, duration in device_timeframes:
-                status['timeframes'][name].append({
-                    'start': start.strftime('%Y-%m-%d %H:%M'),
-                    'end': end.strftime('%Y-%m-%d %H:%M'),
-                    'avg_price': round(avg, 2),
-                    'duration': duration
-                })
-    
-    return jsonify(status)
+            # Get timeframes for this device's threshold, formatted once per timeframe calculation
+            device_timeframes = _sched.get_timeframes_for_threshold(name)
+            cached = _tf_cache.get(name)
+            if cached is None or cached[0] is not device_timeframes:
+                cached = (device_timeframes, [
+                    {'start': start.isoformat(sep=' ', timespec='minutes'), 'end': end.isoformat(sep=' ', timespec='minutes'), 'avg_price': round(avg, 2), 'duration': duration}
+                    for start, end, avg, duration in device_timeframes
+                ])
+                _tf_cache[name] = cached
+            timeframes_out[name] = cached[1]
+    
+    return status
 
 @app.route('/api/prices', methods=['GET'])
-def get_prices():
+async def get_prices():
     """Get electricity price data (filtered to last 3 hours and future)"""
     if not scheduler or not scheduler.last_prices:
-        return jsonify({'prices': [], 'median': 0})
+        return ojson({'prices': [], 'median': 0})
+    
+    # The response only changes when new prices arrive or the 3 hour window moves on
+    last_prices = scheduler.last_prices
+    minute = int(time.time()) // 60
+    if _prices_cache['prices'] is last_prices and _prices_cache['minute'] == minute:
+        return _json_response(_prices_cache['body'])
     
     # Filter prices to only show from 3 hours ago onwards
     current_time = datetime.now()
-    three_hours_ago = current_time - timedelta(hours=3)
-    
-    filtered_prices = []
-    for price_data in scheduler.last_prices:
-        price_time = datetime.fromtimestamp(price_data['timestamp'])
-        if price_time >= three_hours_ago:
-            filtered_prices.append({
-                'timestamp': price_data['timestamp'],
-                'time': price_time.strftime('%Y-%m-%d %H:%M'),
-                'price': round(price_data['price'], 2)
-            })
-    
-    # Calculate median from filtered prices
-    if filtered_prices:
-        median = statistics.median([p['price'] for p in filtered_prices])
-    else:
-        median = 0
+    three_hours_ago_ts = current_time.timestamp() - 3 * 3600
+    
+    # Prices are sorted by timestamp and already carry a formatted 'time', so filtering is a slice
+    start = bisect.bisect_left(last_prices, three_hours_ago_ts, key=lambda p: p['timestamp'])
+    filtered_prices = last_prices[start:]
+    
+    # Calculate median from filtered prices, reusing the scheduler's price array
+    median = float(np.median(scheduler.last_price_values[start:])) if filtered_prices else 0
+    
+    tail = b'],"median":' + _dumps(round(median, 2)) + b',"current_time":' + _dumps(current_time.timestamp()) + b'}'
+    
+    async def stream():
+        # Send the price list in batches as it is encoded, keeping the chunks for the response cache
+        chunks = [b'{"prices":[']
+        yield chunks[0]
+        for i in range(0, len(filtered_prices), PRICES_STREAM_BATCH):
+            chunk = _dumps(filtered_prices[i:i + PRICES_STREAM_BATCH])[1:-1]
+            if i:
+                chunk = b',' + chunk
+            chunks.append(chunk)
+            yield chunk
+        chunks.append(tail)
+        yield tail
+        _prices_cache.update(prices=last_prices, minute=minute, body=b''.join(chunks))
     
-    return jsonify({
-        'prices': filtered_prices,
-        'median': round(median, 2),
-        'current_time': current_time.timestamp()
-    })
+    return app.response_class(stream(), mimetype='application/json')
 
-def run_flask():
-    """Run Flask server"""
-    serve(app, host='0.0.0.0', port=5000, threads=2)
+async def serve_app() -> None:
+    """Serve the web UI on the running event loop"""
+    config = Config()
+    config.bind = ['0.0.0.0:5000']
+    # A shutdown trigger that never fires stops hypercorn from taking over Ctrl+C handling
+    await serve(app, config, shutdown_trigger=lambda: asyncio.Future())
 
-def start_web_server():
-    """Start Flask server in a separate thread"""
+def start_web_server() -> asyncio.Task:
+    """Start the web server as a task on the running event loop"""
+    start_config_writer()
     load_config()
-    flask_thread = Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    web_task = asyncio.create_task(serve_app())
     print("Web server started at http://localhost:5000")
+    return web_task
 
 if __name__ == '__main__':
+    start_config_writer()
     load_config()
-    serve(app, host='0.0.0.0', port=5000, threads=2)
+    asyncio.run(serve_app())